@@ -1,15 +1,21 @@
 import os
 import shutil
+import sys
 import zipfile
 import re
 import json
 import uuid
 import hashlib
+import io
+import logging
+import threading
 from datetime import datetime
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List, Optional, Any, Tuple
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from enum import Enum
 
 from lxml import etree
@@ -27,6 +33,35 @@ BASE_STORAGE_PATH.mkdir(exist_ok=True)
 WORD_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
 W = "{%s}" % WORD_NS
 
+# Полные имена тегов и атрибутов - вычисляются один раз при импорте
+W_P = W + "p"
+W_R = W + "r"
+W_T = W + "t"
+W_RPR = W + "rPr"
+W_VAL = W + "val"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+# Парсер на поток: таблица ID не нужна (getElementById не используется),
+# пробельные узлы сохраняем для точной записи документа обратно;
+# лимиты libxml2 (huge_tree) не отключаем - парсятся загруженные клиентами файлы.
+# Экземпляр парсера lxml сериализует разбор, поэтому у каждого потока свой
+_parser_local = threading.local()
+
+def _xml_parser() -> etree.XMLParser:
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = etree.XMLParser(
+            collect_ids=False, remove_blank_text=False)
+    return parser
+
+# Уже сжатые форматы вложений: повторное сжатие почти не уменьшает размер
+PRECOMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.mp4', '.zip')
+
+# Число потоков пакетного рендеринга; 1 - последовательный рендеринг (для отладки)
+BATCH_RENDER_WORKERS = min(8, os.cpu_count() or 4)
+
+log = logging.getLogger(__name__)
+
 # Регулярные выражения ДЛЯ РУССКОГО ТЕКСТА
 # Замените эти строки:
 CHECKBOX_RE = re.compile(r"\{\{\s*checkbox\s*:\s*(.*?)\s*\}\}")
@@ -36,6 +71,12 @@ TEXT_VARIABLE_RE = re.compile(r"\{\{\s*text\s*:\s*(.*?)\s*\}\}")
 CHECKBOX_RE = re.compile(r'\{\{\s*checkbox\s*:\s*([^{}]+?)\s*\}\}')
 TEXT_VARIABLE_RE = re.compile(r'\{\{\s*text\s*:\s*([^{}]+?)\s*\}\}')
 
+# Оба вида шаблонов за один проход: группа 1 - тип, группа 2 - имя
+TEMPLATE_RE = re.compile(r'\{\{\s*(text|checkbox)\s*:\s*([^{}]+?)\s*\}\}')
+
+# Символы, недопустимые в именах файлов
+INVALID_FILENAME_RE = re.compile(r'[<>:"/\\|?*]')
+
 # -------------------------------------------------------
 # Модели данных
 # -------------------------------------------------------
@@ -64,10 +105,11 @@ class TemplateVariable:
     value: Any = ""
     
     def to_dict(self):
-        data = asdict(self)
+        # Поверхностная копия полей: asdict() глубоко копирует вложенные объекты
+        data = dict(self.__dict__)
         data['type'] = self.type.value
         if self.metadata:
-            data['metadata'] = asdict(self.metadata)
+            data['metadata'] = dict(self.metadata.__dict__)
         return data
 
 @dataclass
@@ -92,7 +134,7 @@ class DocumentTemplate:
             self.metadata = {}
     
     def to_dict(self):
-        data = asdict(self)
+        data = dict(self.__dict__)
         data['variables'] = {k: v.to_dict() for k, v in self.variables.items()}
         return data
 
@@ -115,16 +157,53 @@ class Collection:
             self.templates = []
     
     def to_dict(self):
-        return asdict(self)
+        return dict(self.__dict__)
 
 # -------------------------------------------------------
 # Хранилище данных
 # -------------------------------------------------------
+@lru_cache(maxsize=256)
+def _read_shared_variables(vars_file: str, mtime_ns: int, size: int) -> Tuple[Tuple[str, Any], ...]:
+    """Чтение файла общих переменных; ключ кэша включает mtime и размер файла"""
+    with open(vars_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return tuple(data.get('variables', {}).items())
+
+
+_VARIABLE_TYPES = {t.value: t for t in VariableType}
+
+
+def _template_variable_from_dict(var_name: str, var_data: Dict[str, Any]) -> TemplateVariable:
+    """Восстановление переменной шаблона из записи templates.json"""
+    metadata = var_data.get('metadata')
+    return TemplateVariable(
+        # Имена переменных повторяются во многих шаблонах - храним по одному экземпляру
+        name=sys.intern(var_name),
+        type=_VARIABLE_TYPES.get(var_data.get('type'), VariableType.TEXT),
+        template_string=var_data['template_string'],
+        context=var_data['context'],
+        occurrences=var_data['occurrences'],
+        metadata=VariableMetadata(**metadata) if metadata else None,
+        value=var_data.get('value', '')
+    )
+
+
+def _write_json(path: Path, data: Any):
+    """Атомарная запись JSON: сериализация в строку, запись во временный файл и os.replace"""
+    payload = json.dumps(data, ensure_ascii=False, indent=2)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
 class Storage:
     def __init__(self):
         self.collections: Dict[str, Collection] = {}
         self.templates: Dict[str, DocumentTemplate] = {}
+        # Индекс переменных коллекций: collection_id -> {имя переменной -> запись карты}
+        self._variables_index: Dict[str, Dict[str, Dict]] = {}
         self._load_from_disk()
+        self._build_variables_index()
     
     def _load_from_disk(self):
         collections_file = BASE_STORAGE_PATH / "collections.json"
@@ -140,39 +219,22 @@ class Storage:
                 data = json.load(f)
                 for temp_id, temp_data in data.items():
                     # Восстанавливаем переменные
-                    variables = {}
-                    for var_name, var_data in temp_data.get('variables', {}).items():
-                        var_type = VariableType(var_data['type'])
-                        metadata = None
-                        if var_data.get('metadata'):
-                            metadata = VariableMetadata(**var_data['metadata'])
-                        
-                        variables[var_name] = TemplateVariable(
-                            name=var_name,
-                            type=var_type,
-                            template_string=var_data['template_string'],
-                            context=var_data['context'],
-                            occurrences=var_data['occurrences'],
-                            metadata=metadata,
-                            value=var_data.get('value', '')
-                        )
-                    
-                    temp_data['variables'] = variables
+                    temp_data['variables'] = {
+                        sys.intern(var_name): _template_variable_from_dict(var_name, var_data)
+                        for var_name, var_data in temp_data.get('variables', {}).items()
+                    }
+                    temp_data['collection_id'] = sys.intern(temp_data['collection_id'])
                     self.templates[temp_id] = DocumentTemplate(**temp_data)
     
-    def _save_to_disk(self):
-        collections_data = {k: asdict(v) for k, v in self.collections.items()}
-        with open(BASE_STORAGE_PATH / "collections.json", 'w', encoding='utf-8') as f:
-            json.dump(collections_data, f, ensure_ascii=False, indent=2)
-        
-        templates_data = {}
-        for temp_id, template in self.templates.items():
-            data = asdict(template)
-            data['variables'] = {k: v.to_dict() for k, v in template.variables.items()}
-            templates_data[temp_id] = data
-        
-        with open(BASE_STORAGE_PATH / "templates.json", 'w', encoding='utf-8') as f:
-            json.dump(templates_data, f, ensure_ascii=False, indent=2)
+    def save(self, collections: bool = True, templates: bool = True):
+        """Запись на диск только указанных файлов хранилища"""
+        if collections:
+            collections_data = {k: v.to_dict() for k, v in self.collections.items()}
+            _write_json(BASE_STORAGE_PATH / "collections.json", collections_data)
+        
+        if templates:
+            templates_data = {k: v.to_dict() for k, v in self.templates.items()}
+            _write_json(BASE_STORAGE_PATH / "templates.json", templates_data)
     
     def create_collection(self, name: str, description: str = "") -> Collection:
         collection_id = str(uuid.uuid4())
@@ -183,7 +245,7 @@ class Storage:
             shared_variables_file=f"variables_{collection_id}.json"
         )
         self.collections[collection_id] = collection
-        self._save_to_disk()
+        self.save(templates=False)
         return collection
     
     def get_collection(self, collection_id: str) -> Optional[Collection]:
@@ -205,7 +267,8 @@ class Storage:
             collection.templates.append(template.id)
             collection.updated_at = datetime.now().isoformat()
             self.templates[template.id] = template
-            self._save_to_disk()
+            self._index_template(collection_id, template)
+            self.save()
             return True
         return False
 
@@ -220,9 +283,8 @@ class Storage:
             return {}
         
         try:
-            with open(vars_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('variables', {})
+            stat = vars_file.stat()
+            return dict(_read_shared_variables(str(vars_file), stat.st_mtime_ns, stat.st_size))
         except:
             return {}
     
@@ -240,39 +302,50 @@ class Storage:
             "variables": variables
         }
         
-        with open(vars_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        _write_json(vars_file, data)
+        _read_shared_variables.cache_clear()
         
         return True
 
+    def _build_variables_index(self):
+        """Построение индекса переменных для всех коллекций"""
+        self._variables_index = {}
+        for collection_id, collection in self.collections.items():
+            self._variables_index[collection_id] = {}
+            # Каждый шаблон индексируется один раз
+            for template_id in dict.fromkeys(collection.templates):
+                template = self.templates.get(template_id)
+                if template:
+                    self._index_template(collection_id, template)
+    
+    def _index_template(self, collection_id: str, template: DocumentTemplate):
+        """Добавление переменных шаблона в индекс коллекции (шаблон еще не проиндексирован)"""
+        variables_map = self._variables_index.setdefault(collection_id, {})
+        for var_name, variable in template.variables.items():
+            entry = variables_map.get(var_name)
+            if entry is None:
+                variables_map[var_name] = {
+                    'variable': variable,
+                    'templates': [template.id],
+                    'occurrences': variable.occurrences
+                }
+            else:
+                # Добавляем шаблон к списку: имена переменных в шаблоне уникальны,
+                # а шаблон индексируется один раз - проверка по списку не нужна
+                entry['templates'].append(template.id)
+                
+                # Суммируем occurrences
+                entry['occurrences'] += variable.occurrences
+    
     def get_collection_shared_variables_map(self, collection_id: str) -> Dict[str, Dict]:
         """Возвращает карту общих переменных коллекции с объединением значений"""
-        collection = self.get_collection(collection_id)
-        if not collection:
+        if not self.get_collection(collection_id):
             return {}
-        
-        # Собираем все переменные из всех шаблонов
-        all_variables_map = {}
-        
-        for template_id in collection.templates:
-            template = self.templates.get(template_id)
-            if template and template.variables:
-                for var_name, variable in template.variables.items():
-                    if var_name not in all_variables_map:
-                        all_variables_map[var_name] = {
-                            'variable': variable,
-                            'templates': [template_id],
-                            'occurrences': variable.occurrences
-                        }
-                    else:
-                        # Добавляем шаблон к списку
-                        if template_id not in all_variables_map[var_name]['templates']:
-                            all_variables_map[var_name]['templates'].append(template_id)
-                        
-                        # Суммируем occurrences
-                        all_variables_map[var_name]['occurrences'] += variable.occurrences
-        
-        return all_variables_map
+        # Копия записей индекса: изменения у вызывающего кода не затрагивают индекс
+        return {
+            var_name: dict(entry, templates=list(entry['templates']))
+            for var_name, entry in self._variables_index.get(collection_id, {}).items()
+        }
 
 # -------------------------------------------------------
 # Обработчик документов
@@ -280,15 +353,24 @@ class Storage:
 class DocumentProcessor:
     def __init__(self):
         self.storage = Storage()
+        self._form_checkbox_template = self._build_form_checkbox_template()
     
     def calculate_file_hash(self, file_path: Path) -> str:
-        with open(file_path, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
+        """Хэш файла потоково, блоками по 1 МиБ, без чтения файла в память целиком"""
+        hasher = hashlib.blake2b(digest_size=16)
+        buffer = bytearray(1 << 20)
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hasher.update(view[:n])
+        return hasher.hexdigest()
     
-    def _scan_document_xml(self, doc_path: str) -> Dict[str, Any]:
+    def _scan_document_xml(self, xml_bytes: bytes) -> Dict[str, Any]:
             """Универсальное сканирование XML - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
-            tree = etree.parse(doc_path)
-            root = tree.getroot()
+            root = etree.fromstring(xml_bytes, _xml_parser())
             
             structure = {
                 'text_variables': {},
@@ -301,88 +383,69 @@ class DocumentProcessor:
                 }
             }
             
-            print(f"Начинаем сканирование документа...")
+            log.debug("Начинаем сканирование документа...")
             
-            # Метод 1: Ищем во всем XML как тексте (самый надежный способ)
+            # Метод 1: Ищем во всем XML как тексте (самый надежный способ).
+            # Ищем в сериализованном дереве, а не в исходных байтах: tostring
+            # раскрывает ссылки на символы (&#1060;, &quot;) так же, как их
+            # видит рендеринг в тексте w:t
             xml_text = etree.tostring(root, encoding='unicode', pretty_print=False)
             
-            print(f"Длина XML текста: {len(xml_text)} символов")
-            
-            # ДЕБАГ: Сохраняем XML для анализа
-            debug_file = BASE_STORAGE_PATH / "debug_xml.xml"
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(xml_text)
-            print(f"XML сохранен для отладки: {debug_file}")
-            
-            # ДЕБАГ: Ищем любые фигурные скобки
-            all_curly_braces = re.findall(r'\{\{[^}]*\}\}', xml_text)
-            print(f"Найдено всех шаблонов с фигурными скобками: {len(all_curly_braces)}")
-            for i, match in enumerate(all_curly_braces[:20]):  # Покажем первые 20
-                print(f"  [{i}] '{match}'")
-            
-            # Используем более гибкие регулярные выражения
-            FLEXIBLE_CHECKBOX_RE = re.compile(r'\{\{\s*checkbox\s*:\s*([^{}]+?)\s*\}\}')
-            FLEXIBLE_TEXT_RE = re.compile(r'\{\{\s*text\s*:\s*([^{}]+?)\s*\}\}')
-            
-            # Текстовые переменные
-            text_matches = list(FLEXIBLE_TEXT_RE.finditer(xml_text))
-            print(f"Найдено текстовых переменных по regex: {len(text_matches)}")
+            log.debug("Длина XML текста: %d символов", len(xml_text))
             
-            for match in text_matches:
-                var_name = match.group(1).strip()
-                print(f"  Текстовый шаблон: '{match.group(0)}' -> имя: '{var_name}'")
+            # ДЕБАГ: дамп XML и список всех {{...}} - только при включенном DEBUG
+            if log.isEnabledFor(logging.DEBUG):
+                debug_file = BASE_STORAGE_PATH / "debug_xml.xml"
+                with open(debug_file, 'w', encoding='utf-8') as f:
+                    f.write(xml_text)
+                log.debug("XML сохранен для отладки: %s", debug_file)
                 
-                if var_name:
-                    if var_name not in structure['text_variables']:
-                        # Получаем контекст вокруг найденного шаблона
-                        start = max(0, match.start() - 100)
-                        end = min(len(xml_text), match.end() + 100)
-                        context = xml_text[start:end]
-                        # Очищаем от XML тегов
-                        context = re.sub(r'<[^>]+>', ' ', context)
-                        context = re.sub(r'\s+', ' ', context).strip()[:200]
-                        
-                        structure['text_variables'][var_name] = {
-                            'count': 1,
-                            'contexts': [context if context else "Найдено в документе"],
-                            'value': ''
-                        }
-                    else:
-                        structure['text_variables'][var_name]['count'] += 1
-            
-            # Чекбоксы
-            checkbox_matches = list(FLEXIBLE_CHECKBOX_RE.finditer(xml_text))
-            print(f"Найдено чекбоксов по regex: {len(checkbox_matches)}")
+                all_curly_braces = re.findall(r'\{\{[^}]*\}\}', xml_text)
+                log.debug("Найдено всех шаблонов с фигурными скобками: %d", len(all_curly_braces))
+                for i, match in enumerate(all_curly_braces[:20]):  # Покажем первые 20
+                    log.debug("  [%d] '%s'", i, match)
             
-            for match in checkbox_matches:
-                cb_name = match.group(1).strip()
-                print(f"  Чекбокс шаблон: '{match.group(0)}' -> имя: '{cb_name}'")
+            # Текстовые переменные и чекбоксы - один проход по XML
+            for match in TEMPLATE_RE.finditer(xml_text):
+                var_type, var_name = match.group(1), match.group(2).strip()
+                is_checkbox = var_type == VariableType.CHECKBOX.value
+                log.debug("  Шаблон (%s): '%s' -> имя: '%s'", var_type, match.group(0), var_name)
                 
-                if cb_name:
-                    if cb_name not in structure['checkboxes']:
-                        # Получаем контекст вокруг найденного шаблона
-                        start = max(0, match.start() - 100)
-                        end = min(len(xml_text), match.end() + 100)
-                        context = xml_text[start:end]
-                        # Очищаем от XML тегов
-                        context = re.sub(r'<[^>]+>', ' ', context)
-                        context = re.sub(r'\s+', ' ', context).strip()[:200]
-                        
-                        structure['checkboxes'][cb_name] = {
-                            'count': 1,
-                            'contexts': [context if context else "Найдено в документе"],
-                            'checked_by_default': False
-                        }
+                if not var_name:
+                    continue
+                
+                bucket = structure['checkboxes'] if is_checkbox else structure['text_variables']
+                entry = bucket.get(var_name)
+                if entry is None:
+                    # Получаем контекст вокруг найденного шаблона
+                    start = max(0, match.start() - 100)
+                    end = min(len(xml_text), match.end() + 100)
+                    context = xml_text[start:end]
+                    # Очищаем от XML тегов
+                    context = re.sub(r'<[^>]+>', ' ', context)
+                    context = re.sub(r'\s+', ' ', context).strip()[:200]
+                    
+                    bucket[var_name] = {
+                        'count': 1,
+                        'contexts': [context if context else "Найдено в документе"],
+                    }
+                    if is_checkbox:
+                        bucket[var_name]['checked_by_default'] = False
                     else:
-                        structure['checkboxes'][cb_name]['count'] += 1
+                        bucket[var_name]['value'] = ''
+                else:
+                    entry['count'] += 1
+            
+            log.debug("Найдено по regex: текстовых переменных %d, чекбоксов %d",
+                      len(structure['text_variables']), len(structure['checkboxes']))
             
             # Если ничего не нашли, попробуем альтернативные методы
             if not structure['text_variables'] and not structure['checkboxes']:
-                print("\nПервый метод не нашел переменных. Пробуем альтернативные методы...")
+                log.debug("Первый метод не нашел переменных. Пробуем альтернативные методы...")
                 
                 # Метод 2: Ищем в отдельных w:t элементах (на случай, если шаблон разбит)
-                all_text_elements = root.findall(".//w:t", namespaces={"w": WORD_NS})
-                print(f"Метод 2: Поиск в {len(all_text_elements)} w:t элементах...")
+                all_text_elements = list(root.iter(W_T))
+                log.debug("Метод 2: Поиск в %d w:t элементах...", len(all_text_elements))
                 
                 current_text = ""
                 for t_elem in all_text_elements:
@@ -392,7 +455,7 @@ class DocumentProcessor:
                     # Если текст достаточно длинный или закончился run, проверяем его
                     if len(current_text) > 100 or not text:
                         # Проверяем собранный текст на шаблоны
-                        text_matches = list(FLEXIBLE_TEXT_RE.finditer(current_text))
+                        text_matches = list(TEXT_VARIABLE_RE.finditer(current_text))
                         for match in text_matches:
                             var_name = match.group(1).strip()
                             if var_name and var_name not in structure['text_variables']:
@@ -402,7 +465,7 @@ class DocumentProcessor:
                                     'value': ''
                                 }
                         
-                        checkbox_matches = list(FLEXIBLE_CHECKBOX_RE.finditer(current_text))
+                        checkbox_matches = list(CHECKBOX_RE.finditer(current_text))
                         for match in checkbox_matches:
                             cb_name = match.group(1).strip()
                             if cb_name and cb_name not in structure['checkboxes']:
@@ -424,178 +487,136 @@ class DocumentProcessor:
                 v['count'] for v in structure['checkboxes'].values()
             )
             
-            print(f"\nИтоги сканирования:")
-            print(f"  Уникальных текстовых переменных: {structure['metadata']['unique_text_variables']}")
-            print(f"  Уникальных чекбоксов: {structure['metadata']['unique_checkboxes']}")
-            
-            if structure['text_variables']:
-                print("\nНайденные текстовые переменные:")
-                for var_name, var_data in structure['text_variables'].items():
-                    print(f"  '{var_name}' (встречается {var_data['count']} раз)")
-            
-            if structure['checkboxes']:
-                print("\nНайденные чекбоксы:")
-                for cb_name, cb_data in structure['checkboxes'].items():
-                    print(f"  '{cb_name}' (встречается {cb_data['count']} раз)")
+            log.debug("Итоги сканирования: уникальных текстовых переменных %d, уникальных чекбоксов %d",
+                      structure['metadata']['unique_text_variables'],
+                      structure['metadata']['unique_checkboxes'])
             
             if not structure['text_variables'] and not structure['checkboxes']:
-                print("\n⚠ ВНИМАНИЕ: Переменные не найдены!")
-                print("Возможные причины:")
-                print("  1. В документе нет шаблонов {{text:...}} или {{checkbox:...}}")
-                print("  2. Шаблоны записаны с другими пробелами/символами")
-                print("  3. Документ содержит специальные символы или форматирование")
-                print("\nПроверьте файл debug_xml.xml для анализа структуры документа")
+                log.warning("Переменные не найдены: в документе нет шаблонов {{text:...}} или {{checkbox:...}}, "
+                            "либо они записаны с другими пробелами/символами или разбиты форматированием")
             
             return structure
 
     def scan_template(self, docx_path: Path) -> Tuple[Dict[str, TemplateVariable], str]:
         """Универсальное сканирование шаблона"""
-        workdir = BASE_STORAGE_PATH / f"temp_{uuid.uuid4()}"
+        # Читаем document.xml прямо из архива, без распаковки на диск
+        with zipfile.ZipFile(docx_path, "r") as z:
+            doc_xml = z.read("word/document.xml")
         
-        try:
-            # Распаковываем DOCX
-            self._unzip_docx(docx_path, workdir)
-            doc_xml = workdir / "word" / "document.xml"
-            
-            # Сканируем
-            structure = self._scan_document_xml(str(doc_xml))
-            
-            # Преобразуем в TemplateVariable
-            variables = {}
-            
-            for var_name, var_data in structure['text_variables'].items():
-                variables[var_name] = TemplateVariable(
-                    name=var_name,
-                    type=VariableType.TEXT,
-                    template_string=f"{{{{text:{var_name}}}}}",
-                    context=var_data.get('contexts', []),
-                    occurrences=var_data.get('count', 1),
-                    value=var_data.get('value', '')
-                )
-            
-            for cb_name, cb_data in structure['checkboxes'].items():
-                variables[cb_name] = TemplateVariable(
-                    name=cb_name,
-                    type=VariableType.CHECKBOX,
-                    template_string=f"{{{{checkbox:{cb_name}}}}}",
-                    context=cb_data.get('contexts', []),
-                    occurrences=cb_data.get('count', 1),
-                    value=cb_data.get('checked_by_default', False)
-                )
-            
-            file_hash = self.calculate_file_hash(docx_path)
-            
-            print(f"Найдено переменных: {len(variables)}")
-            for var_name, var in variables.items():
-                print(f"  - {var.name} ({var.type.value})")
-            
-            return variables, file_hash
-            
-        finally:
-            if workdir.exists():
-                shutil.rmtree(workdir)
+        # Сканируем
+        structure = self._scan_document_xml(doc_xml)
+        
+        # Преобразуем в TemplateVariable
+        variables = {}
+        
+        for var_name, var_data in structure['text_variables'].items():
+            variables[var_name] = TemplateVariable(
+                name=var_name,
+                type=VariableType.TEXT,
+                template_string=f"{{{{text:{var_name}}}}}",
+                context=var_data.get('contexts', []),
+                occurrences=var_data.get('count', 1),
+                value=var_data.get('value', '')
+            )
+        
+        for cb_name, cb_data in structure['checkboxes'].items():
+            variables[cb_name] = TemplateVariable(
+                name=cb_name,
+                type=VariableType.CHECKBOX,
+                template_string=f"{{{{checkbox:{cb_name}}}}}",
+                context=cb_data.get('contexts', []),
+                occurrences=cb_data.get('count', 1),
+                value=cb_data.get('checked_by_default', False)
+            )
+        
+        file_hash = self.calculate_file_hash(docx_path)
+        
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Найдено переменных: %d", len(variables))
+            for var in variables.values():
+                log.debug("  - %s (%s)", var.name, var.type.value)
+        
+        return variables, file_hash
     
     
     # Добавьте в класс DocumentProcessor после метода scan_template
-    def _process_xml_file_for_replacement(self, xml_file: Path, variables: Dict[str, Any]) -> bool:
-        """Обработка XML файла для замены переменных с использованием lxml"""
+    def _process_xml_for_replacement(self, part_name: str, xml_bytes: bytes, variables: Dict[str, Any],
+                                     variable_types: Dict[str, VariableType]) -> Optional[bytes]:
+        """Замена переменных в XML части документа с использованием lxml;
+        возвращает новое содержимое части или None, если часть не меняется"""
         try:
+            # Без единой фигурной скобки шаблонов быть не может (даже разбитых
+            # по run-ам) - не парсим и не перезаписываем часть
+            if b"{" not in xml_bytes:
+                return None
+            
             # Парсим XML файл
-            parser = etree.XMLParser(remove_blank_text=False)
-            tree = etree.parse(str(xml_file), parser)
-            root = tree.getroot()
+            root = etree.fromstring(xml_bytes, _xml_parser())
             
             # Разделяем переменные на текстовые и чекбоксы
             text_variables = {}
             checkbox_values = {}
             
             for var_name, var_value in variables.items():
-                template = self.storage.templates
-                # Определяем тип переменной
-                is_checkbox = False
-                
-                # Проверяем по всем шаблонам, какой это тип переменной
-                for template_id, tmpl in template.items():
-                    if var_name in tmpl.variables:
-                        if tmpl.variables[var_name].type == VariableType.CHECKBOX:
-                            is_checkbox = True
-                        break
-                
-                if is_checkbox:
+                # Тип переменной - из карты, построенной один раз на рендер
+                if variable_types.get(var_name) == VariableType.CHECKBOX:
                     checkbox_values[var_name] = bool(var_value)
                 else:
                     text_variables[var_name] = str(var_value)
             
-            statistics = {
-                'text_variables': 0,
-                'checkboxes': 0,
-                'missing_variables': []
-            }
-            
-            # 1. Обработка текстовых переменных
-            if text_variables:
-                text_replaced = 0
-                for p in root.findall(".//w:p", namespaces={"w": WORD_NS}):
+            # Один проход по параграфам: сначала текстовые шаблоны, затем чекбоксы
+            # (чекбоксы ищутся уже в тексте после подстановки, как и раньше)
+            text_replaced = 0
+            checkbox_replaced = 0
+            for p in list(root.iter(W_P)):
+                if text_variables:
                     text_replaced += self._process_templates_in_paragraph(
                         p, TEXT_VARIABLE_RE, self._process_text_template, text_variables
                     )
-                
-                statistics['text_variables'] = text_replaced
-                print(f"Обработано текстовых переменных: {text_replaced}")
-                
-                # Перепарсим для следующего этапа
-                xml_content = etree.tostring(root, encoding='unicode', pretty_print=True)
-                root = etree.fromstring(xml_content.encode('utf-8'))
-            
-            # 2. Обработка чекбоксов
-            if checkbox_values:
-                checkbox_replaced = 0
-                for p in root.findall(".//w:p", namespaces={"w": WORD_NS}):
+                if checkbox_values:
                     checkbox_replaced += self._process_templates_in_paragraph(
                         p, CHECKBOX_RE, self._process_checkbox_template, checkbox_values
                     )
-                
-                statistics['checkboxes'] = checkbox_replaced
-                print(f"Обработано чекбоксов: {checkbox_replaced}")
             
-            # Сохраняем обработанный XML
-            tree = etree.ElementTree(root)
-            tree.write(str(xml_file), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+            if text_variables:
+                log.debug("Обработано текстовых переменных: %d", text_replaced)
             
-            return statistics['text_variables'] + statistics['checkboxes'] > 0
+            if checkbox_values:
+                log.debug("Обработано чекбоксов: %d", checkbox_replaced)
+            
+            # Сериализуем обработанный XML
+            return etree.tostring(root.getroottree(), xml_declaration=True,
+                                  encoding="UTF-8", standalone=True)
             
         except Exception as e:
-            print(f"Ошибка при обработке файла {xml_file}: {e}")
-            return False
+            log.error("Ошибка при обработке части %s: %s", part_name, e)
+            return None
     
     def _process_templates_in_paragraph(self, p, template_re, processor_func, context=None):
         """Обрабатывает шаблоны в параграфе с помощью указанной функции-процессора"""
         # Получаем все run-ы в параграфе
-        runs = p.findall("w:r", namespaces={"w": WORD_NS})
+        runs = list(p.iterchildren(W_R))
         if not runs:
             return 0
         
         # Собираем весь текст параграфа с информацией о пробелах
-        combined = ""
+        chunks = []
         run_info = []  # Храним (run_element, run_text, start_pos_in_combined, end_pos_in_combined)
         
         current_pos = 0
         for run in runs:
             # Собираем ВСЕ текстовые элементы из run
-            text_parts = []
-            for t_elem in run.findall("w:t", namespaces={"w": WORD_NS}):
-                text = t_elem.text if t_elem.text is not None else ""
-                text_parts.append(text)
-            
-            run_text = "".join(text_parts)
+            run_text = "".join([t_elem.text for t_elem in run.iterchildren(W_T) if t_elem.text])
             run_start = current_pos
             run_end = current_pos + len(run_text)
             
-            combined += run_text
+            chunks.append(run_text)
             run_info.append((run, run_text, run_start, run_end))
             
             current_pos = run_end
         
+        combined = "".join(chunks)
+        
         # Ищем все шаблоны в параграфе
         matches = list(re.finditer(template_re, combined))
         
@@ -613,41 +634,7 @@ class DocumentProcessor:
             
             # 1. Добавляем текст ПЕРЕД шаблоном (если есть)
             if match_start > current_pos:
-                text_before = combined[current_pos:match_start]
-                if text_before:
-                    # Находим run-ы, которые содержат этот текст
-                    for run_idx, (run, run_text, run_start, run_end) in enumerate(run_info):
-                        # Если run пересекается с текстом перед шаблоном
-                        if not (run_end <= current_pos or run_start >= match_start):
-                            run_copy = etree.Element(W+"r")
-                            
-                            # Копируем форматирование (если есть)
-                            rPr = run.find(W+"rPr")
-                            if rPr is not None:
-                                # Создаем копию rPr элемента
-                                rPr_copy = etree.Element(W+"rPr")
-                                # Копируем все дочерние элементы rPr
-                                for child in rPr:
-                                    rPr_copy.append(deepcopy(child))
-                                # Копируем атрибуты
-                                for attr_name, attr_value in rPr.attrib.items():
-                                    rPr_copy.set(attr_name, attr_value)
-                                run_copy.append(rPr_copy)
-                            
-                            # Создаем текстовый элемент
-                            t_elem = etree.SubElement(run_copy, W+"t")
-                            
-                            # Определяем, какой текст из этого run нужно взять
-                            clip_start = max(current_pos, run_start) - run_start
-                            clip_end = min(match_start, run_end) - run_start
-                            clipped_text = run_text[clip_start:clip_end]
-                            
-                            # Проверяем, нужно ли сохранять пробелы
-                            if clipped_text and (clipped_text.startswith(' ') or clipped_text.endswith(' ')):
-                                t_elem.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-                            
-                            t_elem.text = clipped_text
-                            new_children.append(run_copy)
+                new_children.extend(self._copy_text_segment(run_info, current_pos, match_start))
             
             # 2. Добавляем сгенерированный элемент (чекбокс или текст)
             generated_elements = processor_func(variable_name, run_info, match_start, context)
@@ -658,90 +645,45 @@ class DocumentProcessor:
         
         # 3. Добавляем текст ПОСЛЕ последнего шаблона (если есть)
         if current_pos < len(combined):
-            text_after = combined[current_pos:]
-            if text_after:
-                # Находим run-ы, которые содержат текст после шаблонов
-                for run_idx, (run, run_text, run_start, run_end) in enumerate(run_info):
-                    if not (run_end <= current_pos or run_start >= len(combined)):
-                        run_copy = etree.Element(W+"r")
-                        
-                        rPr = run.find(W+"rPr")
-                        if rPr is not None:
-                            # Создаем копию rPr элемента
-                            rPr_copy = etree.Element(W+"rPr")
-                            for child in rPr:
-                                rPr_copy.append(deepcopy(child))
-                            for attr_name, attr_value in rPr.attrib.items():
-                                rPr_copy.set(attr_name, attr_value)
-                            run_copy.append(rPr_copy)
-                        
-                        t_elem = etree.SubElement(run_copy, W+"t")
-                        
-                        clip_start = max(current_pos, run_start) - run_start
-                        clip_end = len(combined) - run_start
-                        clipped_text = run_text[clip_start:clip_end]
-                        
-                        if clipped_text and (clipped_text.startswith(' ') or clipped_text.endswith(' ')):
-                            t_elem.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-                        
-                        t_elem.text = clipped_text
-                        new_children.append(run_copy)
+            new_children.extend(self._copy_text_segment(run_info, current_pos, len(combined)))
         
         # 4. Если нашли шаблоны, заменяем содержимое параграфа
         if new_children:
-            # Удаляем все существующие дочерние элементы параграфа
-            for child in list(p):
-                p.remove(child)
-            
-            # Добавляем новые элементы
-            for child in new_children:
-                p.append(child)
+            # Заменяем все дочерние элементы параграфа одной операцией
+            p[:] = new_children
             
             return len(matches)
         
         return 0
     
+    def _copy_text_segment(self, run_info, seg_start, seg_end):
+        """Копирует участок [seg_start, seg_end) текста параграфа в новые run-ы с форматированием исходных"""
+        segment_runs = []
+        for run, run_text, run_start, run_end in run_info:
+            # run_info упорядочен по позиции - дальше участка искать нечего
+            if run_start >= seg_end:
+                break
+            if run_end <= seg_start:
+                continue
+            clipped_text = run_text[max(seg_start, run_start) - run_start:min(seg_end, run_end) - run_start]
+            segment_runs.append(self._make_text_element(clipped_text, run.find(W_RPR)))
+        return segment_runs
+    
     def _process_checkbox_template(self, variable_name, run_info, position, context):
         """Обработчик для чекбоксов"""
-        checkbox_text = variable_name
-        
         # Получаем значение из контекста
         checked_by_default = False
         if context and variable_name in context:
             checked_by_default = bool(context[variable_name])
         
-        # Определяем форматирование из первого run, который содержит шаблон
-        for run, run_text, run_start, run_end in run_info:
-            if run_start <= position < run_end:
-                rPr = run.find(W+"rPr")
-                if rPr is not None:
-                    # Извлекаем шрифт и размер из форматирования
-                    font_elem = rPr.find(W+"rFonts")
-                    size_elem = rPr.find(W+"sz")
-                    
-                    font_name = "Calibri"  # Стандартный шрифт Word
-                    font_size = 22  # Стандартный размер по умолчанию (11 points)
-                    
-                    if font_elem is not None:
-                        font_name = font_elem.get(W+"ascii") or font_elem.get(W+"hAnsi") or "Calibri"
-                    
-                    if size_elem is not None:
-                        try:
-                            # Размер уже в half-points, используем как есть
-                            font_size = int(size_elem.get(W+"val", "22"))
-                        except:
-                            font_size = 22  # 11 points по умолчанию
-                    
-                    return self._make_form_checkbox(checkbox_text, font_name=font_name, 
-                                                   font_size=font_size, checked=checked_by_default)
-                break
-        
-        return self._make_form_checkbox(checkbox_text, checked=checked_by_default)
+        # Word отрисовывает Legacy Checkbox с авторазмером, поэтому
+        # форматирование исходного run здесь не требуется
+        return self._make_form_checkbox(variable_name, checked=checked_by_default)
     
     def _process_text_template(self, variable_name, run_info, position, context):
         """Обработчик для текстовых шаблонов - подставляет значение переменной"""
         if context is None or variable_name not in context:
-            print(f"⚠ Переменная '{variable_name}' не найдена в контексте")
+            log.debug("Переменная '%s' не найдена в контексте", variable_name)
             return []
         
         value = context[variable_name]
@@ -749,69 +691,76 @@ class DocumentProcessor:
         # Определяем форматирование из run, который содержит шаблон
         for run, run_text, run_start, run_end in run_info:
             if run_start <= position < run_end:
-                rPr = run.find(W+"rPr")
+                rPr = run.find(W_RPR)
                 return [self._make_text_element(str(value), rPr)]
         
         return [self._make_text_element(str(value))]
     
-    def _make_form_checkbox(self, name_text: str, font_name="Calibri", font_size=22, checked=False):
+    def _build_form_checkbox_template(self):
         """
-        Простая и рабочая версия Legacy Checkbox
-        Word сам правильно отрисует чекбокс с размером по умолчанию
+        Шаблон Legacy Checkbox: run-ы собираются один раз в контейнере,
+        для каждого чекбокса контейнер копируется целиком
         """
-        runs = []
+        container = etree.Element("runs")
         
         # 1) fldChar begin
-        r_begin = etree.Element(W+"r")
+        r_begin = etree.SubElement(container, W_R)
         fld_begin = etree.SubElement(r_begin, W+"fldChar", {W+"fldCharType":"begin"})
         ffData = etree.SubElement(fld_begin, W+"ffData")
         etree.SubElement(ffData, W+"enabled")
         checkBox = etree.SubElement(ffData, W+"checkBox")
         etree.SubElement(checkBox, W+"sizeAuto")  # Авторазмер - ВАЖНО!
-        default_value = "1" if checked else "0"
-        etree.SubElement(checkBox, W+"default", {W+"val": default_value})
-        etree.SubElement(ffData, W+"name", {W+"val": name_text})
-        runs.append(r_begin)
+        etree.SubElement(checkBox, W+"default", {W_VAL: "0"})
+        etree.SubElement(ffData, W+"name", {W_VAL: ""})
 
         # 2) instrText
-        r_instr = etree.Element(W+"r")
+        r_instr = etree.SubElement(container, W_R)
         instr = etree.SubElement(r_instr, W+"instrText")
-        instr.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+        instr.set(XML_SPACE, "preserve")
         instr.text = " FORMCHECKBOX "
-        runs.append(r_instr)
 
         # 3) fldChar end
-        r_end = etree.Element(W+"r")
+        r_end = etree.SubElement(container, W_R)
         etree.SubElement(r_end, W+"fldChar", {W+"fldCharType":"end"})
-        runs.append(r_end)
 
         # 4) текст справа
-        r_text = etree.Element(W+"r")
-        t = etree.SubElement(r_text, W+"t")
-        t.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-        t.text = " " + name_text
-        runs.append(r_text)
+        r_text = etree.SubElement(container, W_R)
+        t = etree.SubElement(r_text, W_T)
+        t.set(XML_SPACE, "preserve")
 
-        return runs
+        return container
+    
+    def _make_form_checkbox(self, name_text: str, checked=False):
+        """
+        Простая и рабочая версия Legacy Checkbox
+        Word сам правильно отрисует чекбокс с размером по умолчанию
+        """
+        container = deepcopy(self._form_checkbox_template)
+        r_begin, r_instr, r_end, r_text = container
+        
+        # fldChar/ffData: enabled, checkBox (sizeAuto, default), name
+        _, check_box, name = r_begin[0][0]
+        check_box[1].set(W_VAL, "1" if checked else "0")
+        name.set(W_VAL, name_text)
+        r_text[0].text = " " + name_text
+        
+        return [r_begin, r_instr, r_end, r_text]
     
     def _make_text_element(self, text_content: str, rPr_element=None):
         """Создает run с текстом и форматированием"""
-        run = etree.Element(W+"r")
+        run = etree.Element(W_R)
         
         if rPr_element is not None:
-            # Копируем форматирование
-            rPr_copy = etree.Element(W+"rPr")
-            for child in rPr_element:
-                rPr_copy.append(deepcopy(child))
-            for attr_name, attr_value in rPr_element.attrib.items():
-                rPr_copy.set(attr_name, attr_value)
+            # Копируем форматирование целиком (одна копия узла в libxml2)
+            rPr_copy = deepcopy(rPr_element)
+            rPr_copy.tail = None
             run.append(rPr_copy)
         
-        t_elem = etree.SubElement(run, W+"t")
+        t_elem = etree.SubElement(run, W_T)
         
         # Проверяем пробелы в начале или конце
         if text_content.startswith(' ') or text_content.endswith(' '):
-            t_elem.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+            t_elem.set(XML_SPACE, "preserve")
         
         t_elem.text = text_content
         return run
@@ -822,8 +771,18 @@ class DocumentProcessor:
         if not template:
             raise ValueError(f"Template {template_id} not found")
         
-        # Подготавливаем рабочую директорию
-        workdir = BASE_STORAGE_PATH / f"render_{uuid.uuid4()}"
+        output_dir = BASE_STORAGE_PATH / "rendered"
+        output_dir.mkdir(exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_path = output_dir / f"rendered_{template.name}_{timestamp}.docx"
+        
+        output_path.write_bytes(self._render_template(template, variables))
+        
+        log.debug("Документ успешно отрендерен: %s", output_path)
+        return output_path
+    
+    def _render_template(self, template: DocumentTemplate, variables: Dict[str, Any]) -> bytes:
+        """Рендеринг шаблона в память; возвращает содержимое DOCX"""
         templates_dir = BASE_STORAGE_PATH / "templates" / template.collection_id
         template_path = templates_dir / f"{template.id}.docx"
         
@@ -851,43 +810,36 @@ class DocumentProcessor:
                     else:
                         final_variables[var_name] = str(var_data.value)
         
-        print(f"Рендеринг шаблона '{template.name}' с переменными:")
-        for k, v in final_variables.items():
-            print(f"  {k}: {v}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Рендеринг шаблона '%s' с переменными:", template.name)
+            for k, v in final_variables.items():
+                log.debug("  %s: %s", k, v)
         
         try:
-            # Распаковываем DOCX
-            self._unzip_docx(template_path, workdir)
+            # Типы переменных шаблона - общие для всех частей документа
+            variable_types = {name: var.type for name, var in template.variables.items()}
             
-            # Обрабатываем основной документ
-            doc_xml = workdir / "word" / "document.xml"
-            if doc_xml.exists():
-                self._process_xml_file_for_replacement(doc_xml, final_variables)
+            # Обрабатываем основной документ, а также заголовки и колонтитулы
+            # прямо из архива, без распаковки на диск
+            modifications = {}
+            with zipfile.ZipFile(template_path, "r") as zin:
+                for part_name in zin.namelist():
+                    base_name = part_name.rpartition("/")[2]
+                    if part_name == "word/document.xml" or (
+                            base_name.startswith(('header', 'footer')) and base_name.endswith(".xml")):
+                        data = self._process_xml_for_replacement(
+                            part_name, zin.read(part_name), final_variables, variable_types)
+                        if data is not None:
+                            modifications[part_name] = data
             
-            # Также обрабатываем файлы заголовков и колонтитулов
-            for xml_file in workdir.glob("**/*.xml"):
-                if xml_file.name.startswith(('header', 'footer')):
-                    self._process_xml_file_for_replacement(xml_file, final_variables)
-            
-            # Создаем выходной файл
-            output_dir = BASE_STORAGE_PATH / "rendered"
-            output_dir.mkdir(exist_ok=True)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = output_dir / f"rendered_{template.name}_{timestamp}.docx"
-            
-            # Упаковываем обратно в DOCX
-            self._rezip_docx(workdir, output_path)
-            
-            print(f"Документ успешно отрендерен: {output_path}")
-            return output_path
+            # Упаковываем обратно в DOCX (в память)
+            buffer = io.BytesIO()
+            self._rewrite_docx(template_path, buffer, modifications)
+            return buffer.getvalue()
             
         except Exception as e:
-            print(f"Ошибка при рендеринге: {e}")
+            log.error("Ошибка при рендеринге: %s", e)
             raise
-            
-        finally:
-            if workdir.exists():
-                shutil.rmtree(workdir)
     
     def render_batch(self, collection_id: str, template_ids: List[str], 
                     variables: Dict[str, Any]) -> Path:
@@ -896,9 +848,9 @@ class DocumentProcessor:
         if not collection:
             raise ValueError(f"Collection {collection_id} not found")
         
-        # Проверяем шаблоны
+        # Проверяем шаблоны (повторяющиеся ID рендерим один раз)
         templates_to_render = []
-        for template_id in template_ids:
+        for template_id in dict.fromkeys(template_ids):
             template = self.storage.templates.get(template_id)
             if template and template.collection_id == collection_id:
                 templates_to_render.append(template)
@@ -906,67 +858,75 @@ class DocumentProcessor:
         if not templates_to_render:
             raise ValueError("No valid templates to render")
         
-        print(f"Пакетный рендеринг {len(templates_to_render)} документов")
+        log.debug("Пакетный рендеринг %d документов", len(templates_to_render))
+        
+        # Общая метка времени для всех файлов пакета и архива
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        # Понятные имена файлов в архиве назначаются заранее,
+        # совпадающие имена шаблонов получают числовой суффикс
+        jobs = []
+        used_names = set()
+        for template in templates_to_render:
+            base_name = INVALID_FILENAME_RE.sub('_', f"{template.name}_{timestamp}")
+            new_name = f"{base_name}.docx"
+            suffix = 1
+            while new_name in used_names:
+                suffix += 1
+                new_name = f"{base_name}_{suffix}.docx"
+            used_names.add(new_name)
+            jobs.append((template, new_name))
+        
+        # Значения из запроса приводятся к типам один раз на весь пакет
+        text_values = {k: str(v) for k, v in variables.items()}
+        checkbox_values = {k: bool(v) for k, v in variables.items()}
+        
+        def render_one(job):
+            template, new_name = job
+            try:
+                # Подготавливаем переменные для этого шаблона: значение из запроса
+                # нужного типа, иначе сохраненное значение
+                template_variables = {
+                    var_name: (checkbox_values if var.type == VariableType.CHECKBOX
+                               else text_values).get(var_name, var.value)
+                    for var_name, var in template.variables.items()
+                }
+                
+                # Рендерим документ в память - без промежуточных файлов
+                data = self._render_template(template, template_variables)
+                
+                log.debug("Отрендерен шаблон %s: %s", template.name, new_name)
+                return new_name, data
+                
+            except Exception as e:
+                log.error("Ошибка при рендеринге шаблона %s: %s", template.name, e)
+                return None
+        
+        # Шаблоны независимы друг от друга - рендерим параллельно,
+        # map сохраняет исходный порядок документов
+        workers = min(BATCH_RENDER_WORKERS, len(jobs))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(render_one, jobs))
+        else:
+            results = [render_one(job) for job in jobs]
+        rendered_documents = [result for result in results if result is not None]
         
-        # Создаем временную директорию для ZIP архива
-        temp_dir = BASE_STORAGE_PATH / f"batch_{uuid.uuid4()}"
-        temp_dir.mkdir(parents=True, exist_ok=True)
+        if not rendered_documents:
+            raise ValueError("Не удалось отрендерить ни одного документа")
         
-        rendered_files = []
+        # Создаем ZIP архив прямо из отрендеренных данных. DOCX уже сжат
+        # внутри, поэтому документы кладутся в архив без повторного сжатия
+        output_dir = BASE_STORAGE_PATH / "rendered"
+        output_dir.mkdir(exist_ok=True)
+        zip_path = output_dir / f"batch_{collection_id}_{timestamp}.zip"
         
-        try:
-            # Рендерим каждый документ
-            for template in templates_to_render:
-                try:
-                    print(f"Рендеринг шаблона: {template.name}")
-                    
-                    # Подготавливаем переменные для этого шаблона
-                    template_variables = {}
-                    for var_name in template.variables.keys():
-                        if var_name in variables:
-                            if template.variables[var_name].type == VariableType.CHECKBOX:
-                                template_variables[var_name] = bool(variables[var_name])
-                            else:
-                                template_variables[var_name] = str(variables[var_name])
-                        else:
-                            # Используем сохраненное значение
-                            template_variables[var_name] = template.variables[var_name].value
-                    
-                    # Рендерим документ
-                    rendered_path = self.render_document(template.id, template_variables)
-                    
-                    # Копируем в временную директорию с понятным именем
-                    new_name = f"{template.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
-                    new_name = re.sub(r'[<>:"/\\|?*]', '_', new_name)  # Заменяем недопустимые символы
-                    new_path = temp_dir / new_name
-                    shutil.copy2(rendered_path, new_path)
-                    rendered_files.append(new_path)
-                    
-                    print(f"  Успешно: {new_name}")
-                    
-                except Exception as e:
-                    print(f"  Ошибка при рендеринге шаблона {template.name}: {e}")
-            
-            if not rendered_files:
-                raise ValueError("Не удалось отрендерить ни одного документа")
-            
-            # Создаем ZIP архив
-            output_dir = BASE_STORAGE_PATH / "rendered"
-            output_dir.mkdir(exist_ok=True)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            zip_path = output_dir / f"batch_{collection_id}_{timestamp}.zip"
-            
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for file_path in rendered_files:
-                    zipf.write(file_path, file_path.name)
-            
-            print(f"Пакетный рендеринг завершен. ZIP архив: {zip_path}")
-            return zip_path
-            
-        finally:
-            # Очищаем временные файлы
-            if temp_dir.exists():
-                shutil.rmtree(temp_dir)
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            for new_name, data in rendered_documents:
+                zipf.writestr(new_name, data)
+        
+        log.debug("Пакетный рендеринг завершен. ZIP архив: %s", zip_path)
+        return zip_path
     
     def register_template(self, collection_id: str, template_name: str, 
                          docx_file_path: Path, original_filename: str) -> DocumentTemplate:
@@ -1027,20 +987,20 @@ class DocumentProcessor:
         
         return template
     
-    def _unzip_docx(self, src, dst):
-        if os.path.exists(dst):
-            shutil.rmtree(dst)
-        os.makedirs(dst)
-        with zipfile.ZipFile(src, "r") as z:
-            z.extractall(dst)
-    
-    def _rezip_docx(self, src_dir, dst_file):
-        with zipfile.ZipFile(dst_file, "w", zipfile.ZIP_DEFLATED) as z:
-            for root, _, files in os.walk(src_dir):
-                for file in files:
-                    full = os.path.join(root, file)
-                    rel = os.path.relpath(full, src_dir)
-                    z.write(full, rel)
+    def _rewrite_docx(self, src_path, dst_file, modifications: Dict[str, bytes]):
+        """Копирование DOCX с заменой измененных частей: порядок записей и тип
+        сжатия сохраняются, уже сжатые вложения (изображения, видео) не сжимаются"""
+        with zipfile.ZipFile(src_path, "r") as zin, \
+                zipfile.ZipFile(dst_file, "w", zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                data = modifications.get(info.filename)
+                if data is None:
+                    data = zin.read(info)
+                if info.filename.lower().endswith(PRECOMPRESSED_EXTENSIONS):
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = info.compress_type
+                zout.writestr(info, data, compress_type=compress_type)
 
 # -------------------------------------------------------
 # FastAPI приложение
@@ -1112,9 +1072,9 @@ async def upload_template(
         temp_dir.mkdir(exist_ok=True)
         temp_path = temp_dir / f"upload_{uuid.uuid4()}.docx"
         
+        # Копируем загруженный файл блоками по 1 МиБ, не читая его в память целиком
         with open(temp_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+            shutil.copyfileobj(file.file, buffer, 1 << 20)
         
         # Регистрируем
         template = processor.register_template(
@@ -1202,15 +1162,7 @@ async def update_shared_variables(collection_id: str, variables: dict):
             raise HTTPException(status_code=404, detail="Collection not found")
         
         # Сохраняем общие переменные
-        shared_vars_file = BASE_STORAGE_PATH / f"variables_{collection_id}.json"
-        data = {
-            "collection_id": collection_id,
-            "updated_at": datetime.now().isoformat(),
-            "variables": variables
-        }
-        
-        with open(shared_vars_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        processor.storage.save_shared_variables(collection_id, variables)
         
         # Обновляем значения во всех шаблонах коллекции
         for template_id in collection.templates:
@@ -1221,7 +1173,7 @@ async def update_shared_variables(collection_id: str, variables: dict):
                         template.variables[var_name].value = var_value
                 template.updated_at = datetime.now().isoformat()
         
-        processor.storage._save_to_disk()
+        processor.storage.save(collections=False)
         
         return {"status": "success", "message": "Shared variables updated"}
         
@@ -1255,7 +1207,7 @@ async def update_variable_metadata(
         if updated_count == 0:
             raise HTTPException(status_code=404, detail="Variable not found in any template")
         
-        processor.storage._save_to_disk()
+        processor.storage.save(collections=False)
         
         return {"status": "success", "message": "Metadata updated", "updated_templates": updated_count}
         
@@ -1386,9 +1338,8 @@ async def get_collection_variables_stats(collection_id: str):
         
         # Считаем по количеству шаблонов
         templates_count = len(var_info['templates'])
-        if templates_count not in stats["variables_by_template_count"]:
-            stats["variables_by_template_count"][templates_count] = 0
-        stats["variables_by_template_count"][templates_count] += 1
+        by_template_count = stats["variables_by_template_count"]
+        by_template_count[templates_count] = by_template_count.get(templates_count, 0) + 1
         
         # Считаем по типу
         if variable.type == VariableType.TEXT: